@@ -1,5 +1,15 @@
+import hashlib
 import inspect
-from collections import namedtuple
+import json
+import os
+import socket
+import string
+import sys
+import tempfile
+import time
+from bisect import bisect_left
+from functools import lru_cache
+from collections import ChainMap
 from typing import List, Dict, Any, Callable, Iterator, Tuple
 
 from prompt_toolkit import PromptSession
@@ -9,14 +19,12 @@ __version__ = "0.2.0"
 
 
 def _promptr_decorator(name=None, cls=None, parent=None, **kwargs):
-    def decorator(f):
-        if cls is None or cls not in globals():
-            raise TypeError(
-                f"Must specify a valid class. '{cls}' is not valid."
-            )
-
-        Cls = globals()[cls]
+    # Resolve the class once per decorator rather than once per decoration
+    Cls = cls if isinstance(cls, type) else _CLASS_REGISTRY.get(cls)
+    if Cls is None or not issubclass(Cls, Base):
+        raise TypeError(f"Must specify a valid class. '{cls}' is not valid.")
 
+    def decorator(f):
         if isinstance(f, Command):
             raise TypeError("Attempt to convert a command twice")
 
@@ -27,15 +35,8 @@ def _promptr_decorator(name=None, cls=None, parent=None, **kwargs):
         except AttributeError:
             params = []
 
-        help = kwargs.get("help")
-        if help is None:
-            help = inspect.getdoc(f)
-            if isinstance(help, bytes):
-                help = help.decode("utf-8")
-        else:
-            help = inspect.cleandoc(help)
-
-        kwargs["help"] = help
+        # Cleaned lazily by Base.help, most commands never render it
+        kwargs.setdefault("help", None)
         kwargs['parent'] = parent
 
         cmd = Cls(
@@ -44,16 +45,94 @@ def _promptr_decorator(name=None, cls=None, parent=None, **kwargs):
             params=params,
             **kwargs
         )
-        cmd.__doc__ = f.__doc__
 
         if parent is not None:
-            parent._children.append(cmd)
+            parent._add_child(cmd)
 
         return cmd
 
     return decorator
 
 
+def _decorator_method(cls: str, owner_cls: str, owner: str) -> Callable:
+    """Build the command, group, and state methods of Group and Prompt
+
+    Args:
+        cls: Name of the class created by default
+        owner_cls: Name of the class the method is defined on
+        owner: How the owning class is described in the docstring
+    """
+    kind = cls.lower()
+
+    def method(self, *args, **kwargs: Dict[str, Any]):
+        kwargs.setdefault('cls', cls)
+        kwargs['parent'] = self._root if isinstance(self, Prompt) else self
+        return _promptr_decorator(*args, **kwargs)
+
+    method.__name__ = kind
+    method.__qualname__ = f"{owner_cls}.{kind}"
+    method.__doc__ = f"""Add a {kind} to this {owner}
+
+        Args:
+            kwargs: Dictionary of keyword arguments
+
+                *cls*
+                    The class, or name of a registered class, to use
+                    to create the {kind} *default* :obj:`{cls}`
+        """
+    return method
+
+
+@lru_cache(maxsize=128)
+def _prefix_matches(names: Tuple[str, ...], prefix: str) -> Tuple[str, ...]:
+    return tuple(name for name in names if name.startswith(prefix))
+
+
+@lru_cache(maxsize=128)
+def _prefix_completions(names: Tuple[str, ...],
+                        prefix: str) -> Tuple[Tuple[str, bool], ...]:
+    return tuple(
+        (name, name == prefix) for name in _prefix_matches(names, prefix)
+    )
+
+
+_EMPTY: tuple = ()
+
+_FORMATTER = string.Formatter()
+
+_MAX_CHAR = chr(sys.maxunicode)
+
+
+def _prefix_successor(prefix: str) -> str:
+    """Get the smallest string greater than every string starting with `prefix`
+
+    Returns None when there is no such string, i.e. `prefix` is made up only
+    of the highest code point.
+    """
+    stripped = prefix.rstrip(_MAX_CHAR)
+    if stripped == "":
+        return None
+    return stripped[:-1] + chr(ord(stripped[-1]) + 1)
+
+
+def _cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "promptr")
+
+
+@lru_cache(maxsize=None)
+def _get_host_info() -> Tuple[str, str, str]:
+    fqdn = socket.gethostname()
+    fqdn_parts = fqdn.split(".")
+    host = fqdn_parts[0]
+    domain = ""
+    if len(fqdn_parts) > 1:
+        domain = ".".join(fqdn_parts[1:])
+    return fqdn, host, domain
+
+
 class PromptrError(RuntimeError):
     """promptr base error
     """
@@ -138,10 +217,47 @@ class Argument(object):
             *completions*
                 Either a :obj:`list` of :obj:`str`, or a generator
                 that yields :obj:`str`.
+
+            *completions_ttl*
+                The number of seconds that the result of a callable
+                `completions` is cached for. *default*: None, cache
+                until :meth:`invalidate` is called.
+
+            *completions_persistent*
+                When True the result of a callable `completions` is also
+                saved under the user's cache directory and reused by later
+                sessions, subject to `completions_ttl`. *default*: False
+
+            *completions_cache_key*
+                A :obj:`str` identifying the persistent cache entry. Only
+                required when `completions` is not a plain function without
+                a closure, such as a bound method or a
+                :func:`functools.partial`, since their results may depend
+                on state that can't be identified automatically.
         """
+    __slots__ = (
+        "_name", "_completions", "_cache", "_cache_ttl", "_cache_time",
+        "_persistent", "_cache_key", "_sorted", "_sorted_source", "_kwargs",
+        "__weakref__"
+    )
+
     def __init__(self, name: str, **kwargs: Dict[str, Any]):
         self._name = name
         self._completions: List[str] = kwargs.pop("completions", [])
+        self._cache: List[str] = None
+        self._cache_ttl: float = kwargs.pop("completions_ttl", None)
+        self._cache_time = 0.0
+        self._persistent: bool = kwargs.pop("completions_persistent", False)
+        self._cache_key: str = kwargs.pop("completions_cache_key", None)
+        if self._persistent and self._cache_key is None:
+            provider = self._completions
+            if not inspect.isfunction(provider) or provider.__closure__:
+                raise ValueError(
+                    f"Argument '{name}' needs a completions_cache_key to "
+                    f"persist completions from {provider!r}"
+                )
+        self._sorted: List[str] = []
+        self._sorted_source: List[str] = None
         self._kwargs = kwargs
 
     @property
@@ -155,13 +271,209 @@ class Argument(object):
         """Return a list of completions that are valid for this :obj:`Argument`
         """
         if callable(self._completions):
-            return self._completions()
+            if self._cache is None or (
+                self._cache_ttl is not None and
+                time.monotonic() - self._cache_time >= self._cache_ttl
+            ):
+                self._cache = self._resolve()
+            return self._cache
         return self._completions
 
+    def _resolve(self) -> List[str]:
+        if self._persistent:
+            completions = self._load_persistent()
+            if completions is not None:
+                return completions
+
+        completions = list(self._completions())
+        self._cache_time = time.monotonic()
+        if self._persistent:
+            self._store_persistent(completions)
+        return completions
+
+    def _persistent_path(self) -> str:
+        key = self._cache_key
+        if key is None:
+            provider = self._completions
+            key = "{}:{}:{}:{}:{}".format(
+                provider.__module__,
+                provider.__qualname__,
+                provider.__code__.co_filename,
+                provider.__code__.co_firstlineno,
+                self._name,
+            )
+        return os.path.join(
+            _cache_dir(),
+            hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json"
+        )
+
+    def _load_persistent(self) -> List[str]:
+        path = self._persistent_path()
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if self._cache_ttl is not None and age >= self._cache_ttl:
+                return None
+            with open(path, "r") as fp:
+                completions = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(completions, list) or not all(
+            isinstance(completion, str) for completion in completions
+        ):
+            return None
+        self._cache_time = time.monotonic() - age
+        return completions
+
+    def _store_persistent(self, completions: List[str]):
+        # The disk cache is best effort, failing to write it isn't an error
+        path = self._persistent_path()
+        try:
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            # Each writer gets its own temporary file so that concurrent
+            # sessions can't interleave their writes
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, suffix=".tmp", delete=False
+            ) as fp:
+                json.dump(completions, fp)
+            try:
+                os.replace(fp.name, path)
+            except OSError:
+                os.remove(fp.name)
+                raise
+        except OSError:
+            pass
+
+    def matching(self, prefix: str) -> Iterator[str]:
+        """Yield the completions that start with `prefix` in sorted order
+
+        Args:
+            prefix: The partial argument to match against
+        """
+        completions = self.completions
+        if isinstance(self._completions, list):
+            # A static list can be changed in place by its owner, so compare
+            # against a copy of what was last sorted
+            if self._sorted_source != completions:
+                self._sorted = sorted(completions)
+                self._sorted_source = completions[:]
+        elif self._sorted_source is not completions:
+            # Provider results are rebuilt on refresh, and tuples can't change
+            self._sorted = sorted(completions)
+            self._sorted_source = completions
+
+        ordered = self._sorted
+        if prefix == "":
+            yield from ordered
+            return
+
+        # Every completion sharing the prefix sits in one contiguous run,
+        # which ends before the prefix's successor
+        start = bisect_left(ordered, prefix)
+        successor = _prefix_successor(prefix)
+        if successor is None:
+            end = len(ordered)
+        else:
+            end = bisect_left(ordered, successor, start)
+        yield from ordered[start:end]
+
+    def invalidate(self):
+        """Discard any cached completions
+
+        The next access to :attr:`completions` will call the completions
+        function again.
+        """
+        self._cache = None
+        if self._persistent and callable(self._completions):
+            try:
+                os.remove(self._persistent_path())
+            except OSError:
+                pass
+
     def __repr__(self):
         return "<Argument {} {}>".format(self.name, self.completions)
 
 
+class _Trie(object):
+    """Minimal prefix tree
+
+    Maps string keys to the list of values registered under them, allowing
+    exact and prefix lookups in O(len(key)) rather than scanning every key.
+    Prefix lookups return keys in the order they were first inserted.
+    """
+    __slots__ = ("_nodes", "_values", "_index", "_count")
+
+    def __init__(self):
+        self._nodes: Dict[str, '_Trie'] = {}
+        self._values: List[Any] = []
+        # Insertion position of this node's key, and the number of keys
+        # inserted so far when this node is the root
+        self._index: int = None
+        self._count = 0
+
+    def insert(self, key: str, value: Any):
+        """Register `value` under `key`
+        """
+        node = self
+        for char in key:
+            child = node._nodes.get(char)
+            if child is None:
+                child = node._nodes[char] = _Trie()
+            node = child
+        if node._index is None:
+            node._index = self._count
+            self._count += 1
+        node._values.append(value)
+
+    def _find(self, prefix: str) -> '_Trie':
+        node = self
+        for char in prefix:
+            node = node._nodes.get(char)
+            if node is None:
+                return None
+        return node
+
+    def get(self, key: str) -> List[Any]:
+        """Get the values registered under exactly `key`
+        """
+        node = self._find(key)
+        if node is None:
+            return []
+        return node._values
+
+    def items(self, prefix: str = "") -> Iterator[Tuple[str, Any]]:
+        """Yield every `(key, value)` pair whose key starts with `prefix`
+
+        Keys are yielded in insertion order, and each key's values in the
+        order they were registered.
+        """
+        node = self._find(prefix)
+        if node is None:
+            return
+        found = []
+        stack = [(prefix, node)]
+        while stack:
+            key, node = stack.pop()
+            if node._values:
+                found.append((node._index, key, node._values))
+            stack.extend(
+                (key + char, child) for char, child in node._nodes.items()
+            )
+        found.sort(key=lambda match: match[0])
+        for _, key, values in found:
+            for value in values:
+                yield key, value
+
+    def keys(self, prefix: str = "") -> Iterator[str]:
+        """Yield every key that starts with `prefix`
+        """
+        last = None
+        for key, _ in self.items(prefix):
+            if key != last:
+                yield key
+                last = key
+
+
 class Base(object):
     """Base class for most promptr objects
 
@@ -185,6 +497,13 @@ class Base(object):
                 should be a :obj:`list` of :obj:`str` that will be used as additional,
                 optional prefixes when performing command completion.
     """
+    __slots__ = (
+        "_name", "_callback", "_params", "_kwargs", "_help", "_help_resolved",
+        "_repr_tail", "_parent", "_children", "_child_trie", "_child_names",
+        "_last_call_kwargs", "_names", "_auto_context", "_pass_name",
+        "_prompt_ref", "__weakref__"
+    )
+
     def __init__(
         self, name: str, callback: Callable, params: List[Argument],
         parent: 'Base', **kwargs: Dict[str, Any]
@@ -193,18 +512,64 @@ class Base(object):
         self._callback = callback
         self._params = params
         self._kwargs = kwargs
+        self._help = None
+        self._help_resolved = False
+        self._repr_tail = None
         self._parent = parent
         self._children = []
+        self._child_trie = _Trie()
+        self._child_names: Dict[str, List['Base']] = {}
         self._last_call_kwargs = {}
 
-        self._names = [self._name]
-        for prefix in kwargs.get('optional_prefixes', []):
-            self._names.append('{} {}'.format(prefix, self._name))
+        self._names = (self._name, ) + tuple(
+            f'{prefix} {self._name}'
+            for prefix in kwargs.get('optional_prefixes') or _EMPTY
+        )
 
-        self._auto_context = kwargs.get('pass_context', [])
+        self._auto_context = kwargs.get('pass_context') or _EMPTY
 
         self._pass_name = kwargs.get('pass_name', False)
 
+        self._prompt_ref: 'Prompt' = None
+
+    def _add_child(self, child: 'Base'):
+        """Attach a child and index it by each of the names it answers to
+        """
+        self._children.append(child)
+        for name in child.names:
+            self._child_trie.insert(name, child)
+            self._child_names.setdefault(name, []).append(child)
+
+    def _find_children(self, cmd: str, limit: int = None) -> List['Base']:
+        """Find the children that `cmd` refers to
+
+        Children with a name exactly matching `cmd` take precedence, otherwise
+        every child with a name starting with `cmd` is returned. A child is
+        returned once however many of its names match, unless it is passed
+        the name it was called by, in which case each match counts.
+
+        Args:
+            cmd: The command to match against
+            limit: Stop looking once this many children have been found.
+                Callers that only need to tell one match from many pass 2.
+        """
+        # Fully typed names are the common case, so try a plain dict first
+        exact = self._child_names.get(cmd)
+        if exact is not None:
+            return exact
+        found = []
+        seen = set()
+        for name, child in self._child_trie.items(cmd):
+            # A child can match through several of its names. Count it once,
+            # unless the matched name is passed on to its callback.
+            key = (name, child) if child._pass_name else child
+            if key not in seen:
+                seen.add(key)
+                found.append(child)
+                if len(found) == limit:
+                    break
+        return found
+
     def list_children(
         self,
         p: Callable = print,
@@ -247,8 +612,9 @@ class Base(object):
         if self._pass_name:
             kwargs['called_name'] = self.get_completions(cmd)[0][0]
 
-        prompt = None
-        if len(self._params) > 0 or len(self._auto_context) > 0:
+        # The tree doesn't change once built, so only find the prompt once
+        prompt = self._prompt_ref
+        if prompt is None and (self._params or self._auto_context):
             curr_cmd = self
             while prompt is None and hasattr(curr_cmd, '_parent'):
                 curr_cmd = curr_cmd._parent
@@ -256,6 +622,7 @@ class Base(object):
                 if hasattr(curr_cmd, 'set_context'):
                     # Found top-level prompt
                     prompt = curr_cmd
+            self._prompt_ref = prompt
 
         ## TODO: Parse these correctly
         for param in self._params:
@@ -274,129 +641,124 @@ class Base(object):
         self._last_call_kwargs = kwargs
 
     @property
-    def names(self) -> List[str]:
+    def names(self) -> Tuple[str, ...]:
         """Get the names that this command can be called by"""
         return self._names
 
+    @property
+    def help(self) -> str:
+        """Get the help text
+
+        Taken from the `help` keyword argument or, failing that, from the
+        callback's docstring. Cleaned with :func:`inspect.cleandoc` the first
+        time it is read.
+        """
+        if not self._help_resolved:
+            help = self._kwargs.get("help")
+            if help is None and self._callback is not None:
+                help = self._callback.__doc__
+            if help is not None:
+                help = inspect.cleandoc(help)
+            self._help = help
+            self._help_resolved = True
+        return self._help
+
     @property
     def hasParams(self) -> bool:
         return len(self._params) > 0
 
-    def completions(self, cmd: str) -> Iterator[str]:
+    def completions(self, cmd: str) -> Tuple[str, ...]:
         """Get all matching completions
 
-        Generator that yields :obj:`str` when the `cmd` matches one of
-        this command's `names`.
+        Returns a tuple of this command's `names` that start with `cmd`.
+        Results are cached, as `names` never changes after construction.
 
         Args:
             cmd: The command to match against
         """
-        for name in self.names:
-            if name.startswith(cmd):
-                yield name
+        return _prefix_matches(self._names, cmd)
 
-    def get_completions(self, cmd: str) -> List[Tuple[str, bool]]:
+    def get_completions(self, cmd: str) -> Tuple[Tuple[str, bool], ...]:
         """Get all matching completions
 
-        Returns a list of matches and whether they are exact or not.
+        Returns a tuple of matches and whether they are exact or not. Results
+        are cached in the same way as :meth:`completions`.
 
         Args:
             cmd: The command to match against
         """
-        return [(name, name == cmd) for name in self.completions(cmd)]
+        return _prefix_completions(self._names, cmd)
 
-    def child_completions(self, line_parts, last_word):
-        """
+    def child_completions(self, line_parts: List[str],
+                          last_word: str) -> Iterator[str]:
+        """Get the completions for the word under the cursor
+
+        Walks forward from this instance through the words that have already
+        been typed, consuming arguments along the way, and then yields either
+        the matching argument completions or the matching child names.
 
+        Args:
+            line_parts: The words of the line, the last of which is the word
+                under the cursor
+            last_word: The partial word that is being completed
         """
         state = self
-        child_complete = True
+        # Index of the next argument of `state` still to be filled, this
+        # instance's own arguments were given when it was entered
+        arg = len(self._params)
 
-        if len(line_parts) > 1:
-            for word in line_parts:
-                if word == '':
-                    continue
-                for child in state._children:
-                    completions = child.get_completions(word)
-                    exact_found = any([c[1] for c in completions])
-
-                    if exact_found or len(completions) == 1:
-                        state = child
-                        if state.hasParams:
-                            child_complete = False
-
-        if not child_complete:
-            for param in state._params:
-                for completion in param.completions:
-                    if completion.startswith(last_word):
-                        yield completion
-
-        if child_complete:
-            for child in state._children:
-                for name in child.completions(last_word):
-                    if name.startswith(last_word):
-                        yield name
+        for word in line_parts[:-1]:
+            if word == '':
+                continue
+            if arg < len(state._params):
+                arg += 1
+                continue
+            if state is not self and isinstance(state, State):
+                # Anything after a state's arguments is never run
+                return
+
+            matches = state._find_children(word, limit=2)
+            if len(matches) != 1:
+                return
+            state = matches[0]
+            arg = 0
+
+        if arg < len(state._params):
+            yield from state._params[arg].matching(last_word)
+        elif state is self or not isinstance(state, State):
+            if last_word == '':
+                # Every name matches, so skip walking the whole trie
+                yield from state._child_names
+            else:
+                yield from state._child_trie.keys(last_word)
 
     def __repr__(self):
-        return "<{} {} {} {}>".format(
-            self.__class__.__name__,
-            self._name,
-            self._params,
-            ", ".join(
-                ["{}={}".format(k, v) for k, v in sorted(self._kwargs.items())]
-            ),
+        if self._repr_tail is None:
+            kwargs = self._kwargs
+            if "help" in kwargs:
+                kwargs = dict(kwargs, help=self.help)
+            self._repr_tail = ", ".join(
+                f"{k}={v}" for k, v in sorted(kwargs.items())
+            )
+        return (
+            f"<{type(self).__name__} {self._name} {self._params} "
+            f"{self._repr_tail}>"
         )
 
 
 class Command(Base):
-    pass
+    __slots__ = ()
 
 
 class Group(Base):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(Group, self).__init__(*args, **kwargs)
 
-    def command(self, *args, **kwargs: Dict[str, Any]):
-        """Add a command to this group
-
-        Args:
-            kwargs: Dictionary of keyword arguments
-
-                *cls*
-                    Name of the class to use to create the
-                    command *default* :obj:`Command`
-        """
-        kwargs.setdefault('cls', 'Command')
-        kwargs['parent'] = self
-        return _promptr_decorator(*args, **kwargs)
-
-    def group(self, *args, **kwargs: Dict[str, Any]):
-        """Add a group to this group
-
-        Args:
-            kwargs: Dictionary of keyword arguments
-
-                *cls*
-                    Name of the class to use to create the
-                    group *default* :obj:`Group`
-        """
-        kwargs.setdefault('cls', 'Group')
-        kwargs['parent'] = self
-        return _promptr_decorator(*args, **kwargs)
-
-    def state(self, *args, **kwargs: Dict[str, Any]):
-        """Add a state to this group
-
-        Args:
-            kwargs: Dictionary of keyword arguments
-
-                *cls*
-                    Name of the class to use to create the
-                    state *default* :obj:`State`
-        """
-        kwargs.setdefault('cls', 'State')
-        kwargs['parent'] = self
-        return _promptr_decorator(*args, **kwargs)
+    command = _decorator_method("Command", "Group", "group")
+    group = _decorator_method("Group", "Group", "group")
+    state = _decorator_method("State", "Group", "group")
 
     def call_child(self, line_parts):
         if len(line_parts) > 0:
@@ -405,23 +767,12 @@ class Group(Base):
             if cmd == "":
                 return None
 
-            possible = []
-            exact_matches = []
-            for child in self._children:
-                for completion, exact in child.get_completions(cmd):
-                    if exact:
-                        exact_matches.append(child)
-                    else:
-                        possible.append(child)
+            matches = self._find_children(cmd, limit=2)
 
-            if len(exact_matches) > 1:
-                raise AmbiguousCommand(cmd, line_parts)
-            elif len(exact_matches) == 1:
-                child = exact_matches[0]
-            elif len(possible) > 1:
+            if len(matches) > 1:
                 raise AmbiguousCommand(cmd, line_parts)
-            elif len(possible) == 1:
-                child = possible[0]
+            elif len(matches) == 1:
+                child = matches[0]
             else:
                 raise CommandNotFound(cmd, line_parts)
 
@@ -436,10 +787,24 @@ class Group(Base):
 
 
 class State(Group):
+    __slots__ = (
+        "_prompt", "_prompt_cache_source", "_prompt_cache_value", "_on_exit"
+    )
+
     def __init__(self, *args, **kwargs):
         super(State, self).__init__(*args, **kwargs)
+        # States can only be entered by their own name
+        self._names = (self._name, )
 
         self._prompt = kwargs.get("prompt", None)
+        self._prompt_cache_source = None
+        self._prompt_cache_value = None
+        if self._prompt is not None and all(
+            field is None for _, field, _, _ in _FORMATTER.parse(self._prompt)
+        ):
+            # No fields to fill in, so format once and always use the cache
+            self._prompt_cache_value = self._prompt.format()
+            self._prompt = None
         self._on_exit = None
 
         self.command(name="exit")(self._exit_state)
@@ -456,31 +821,92 @@ class State(Group):
             self._on_exit()
         raise ExitState()
 
-    @property
-    def names(self):
-        return [self._name]
-
     def get_prompt(self):
-        if self._prompt is not None:
-            return self._prompt.format(**self._last_call_kwargs)
-        return None
+        if self._prompt is None:
+            return self._prompt_cache_value
+        # call() replaces _last_call_kwargs rather than mutating it
+        if self._prompt_cache_source is not self._last_call_kwargs:
+            self._prompt_cache_value = self._prompt.format(
+                **self._last_call_kwargs
+            )
+            self._prompt_cache_source = self._last_call_kwargs
+        return self._prompt_cache_value
 
 
-StackItem = namedtuple("StackItem", ["state", "context"])
+_CLASS_REGISTRY: Dict[str, type] = {
+    c.__name__: c
+    for c in (Base, Command, Group, State)
+}
+
+
+def register_class(cls: type) -> type:
+    """Register a class so that it can be referred to by name
+
+    Once registered the class's name can be passed as the `cls` keyword when
+    creating a state, group, or command. Can be used as a class decorator.
+
+    Args:
+        cls: A sub-class of :obj:`Base`
+    """
+    _CLASS_REGISTRY[cls.__name__] = cls
+    return cls
+
+
+class StackItem(object):
+    """An entry on the :obj:`Prompt` state stack
+
+    Args:
+        state: The state that was entered
+        context: The context values set while in this state
+    """
+    __slots__ = ("state", "context")
+
+    def __init__(self, state: Group, context: Dict[str, Any]):
+        self.state = state
+        self.context = context
+
+
+_STATE_MARKER = "\0"
 
 
 class PromptrCompleter(Completer):
+    """prompt_toolkit completer for a :obj:`Prompt`
+
+    Completions are produced lazily and generation stops once a time budget,
+    measured from the first completion, is spent so that large completion
+    sets can't stall the prompt. The budget is larger when the user
+    explicitly asked for completions.
+    """
+    budget = 0.05
+    requested_budget = 0.4
+
     def __init__(self, prompt, *args, **kwargs):
         super(PromptrCompleter, self).__init__(*args, **kwargs)
         self._prompt = prompt
 
     def get_completions(self, document, complete_event):
+        budget = self.budget
+        if complete_event is not None and complete_event.completion_requested:
+            budget = self.requested_budget
+        deadline = None
+
         last_word = document.get_word_before_cursor()
-        line_parts = document.text.split(" ")
+        text = document.text_before_cursor
+        line_parts = text.split()
+        if text == "" or text[-1].isspace():
+            # The cursor is at the start of a new, empty word
+            line_parts.append("")
         for word in self._prompt.current_state.child_completions(
             line_parts, last_word
         ):
             yield Completion(word, -len(last_word))
+            # The clock starts once the first completion is ready, so that
+            # time spent fetching argument completions isn't counted
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + budget
+            elif now >= deadline:
+                break
 
 
 class Prompt:
@@ -493,14 +919,7 @@ class Prompt:
         extra_completions=None,
         **kwargs
     ):
-        import socket
-
-        fqdn = socket.gethostname()
-        fqdn_parts = fqdn.split(".")
-        host = fqdn_parts[0]
-        domain = ""
-        if len(fqdn_parts) > 1:
-            domain = ".".join(fqdn_parts[1:])
+        fqdn, host, domain = _get_host_info()
 
         self._completions = {"fqdn": fqdn, "host": host, "domain": domain}
         if extra_completions is not None:
@@ -508,60 +927,44 @@ class Prompt:
 
         self._root = Group("_root", None, [], self)
         self._root.command(name="exit")(self._exit_state)
-        self._state_stack = [StackItem(self._root, {})]
+        # Mirrors the state stack so that context set in a state falls
+        # through to the states below it
+        self._context_chain = ChainMap()
+        self._state_stack = [StackItem(self._root, self._context_chain.maps[0])]
         self._prompt_states = []
 
         self._prompt_fmt = prompt_fmt
+        self._prompt_parts = self._split_prompt_fmt()
+        self._prompt_cache = None
         self._state_delim = state_delim
         self._state_paren_l = state_paren_l
         self._state_paren_r = state_paren_r
 
-        self.list_children = self._root.list_children
-
-    def command(self, *args, **kwargs: Dict[str, Any]):
-        """Add a command to this promptr instance
+        self._completer = PromptrCompleter(self)
+        self._session = None
+        self._session_kwargs = None
 
-        Args:
-            kwargs: Dictionary of keyword arguments
-
-                *cls*
-                    Name of the class to use to create the
-                    command *default* :obj:`Command`
-        """
-        kwargs.setdefault('cls', 'Command')
-        kwargs['parent'] = self._root
-        return _promptr_decorator(*args, **kwargs)
-
-    def group(self, *args, **kwargs: Dict[str, Any]):
-        """Add a group to this promptr instance
-
-        Args:
-            kwargs: Dictionary of keyword arguments
+        self.list_children = self._root.list_children
 
-                *cls*
-                    Name of the class to use to create the
-                    group *default* :obj:`Group`
-        """
-        kwargs.setdefault('cls', 'Group')
-        kwargs['parent'] = self._root
-        return _promptr_decorator(*args, **kwargs)
+    command = _decorator_method("Command", "Prompt", "promptr instance")
+    group = _decorator_method("Group", "Prompt", "promptr instance")
+    state = _decorator_method("State", "Prompt", "promptr instance")
 
-    def state(self, *args, **kwargs: Dict[str, Any]):
-        """Add a state to this promptr instance
+    def _exit_state(self):
+        raise ExitState()
 
-        Args:
-            kwargs: Dictionary of keyword arguments
+    def invalidate_completions(self):
+        """Discard the cached completions of every :obj:`Argument`
 
-                *cls*
-                    Name of the class to use to create the
-                    state *default* :obj:`State`
+        Should be called when the data backing any completions functions
+        has changed.
         """
-        kwargs.setdefault('cls', 'State')
-        kwargs['parent'] = self._root
-        return _promptr_decorator(*args, **kwargs)
-
-    def _exit_state(self):
-        raise ExitState()
+        stack = [self._root]
+        while stack:
+            cmd = stack.pop()
+            for param in cmd._params:
+                param.invalidate()
+            stack.extend(cmd._children)
 
     def argument(self, *args, **kwargs):
         def decorator(f):
@@ -581,34 +984,72 @@ class Prompt:
 
     @property
     def current_prompt(self):
-        state = ""
-        if len(self._prompt_states) > 0:
-            state = "{}{}{}".format(
-                self._state_paren_l,
-                self._state_delim.join(self._prompt_states),
-                self._state_paren_r,
-            )
-        return self._prompt_fmt.format(state=state, **self._completions)
+        # Only changes when a state is pushed or popped
+        if self._prompt_cache is None:
+            state = ""
+            if len(self._prompt_states) > 0:
+                state = (
+                    f"{self._state_paren_l}"
+                    f"{self._state_delim.join(self._prompt_states)}"
+                    f"{self._state_paren_r}"
+                )
+            if self._prompt_parts is not None:
+                self._prompt_cache = state.join(self._prompt_parts)
+            else:
+                self._prompt_cache = self._prompt_fmt.format(
+                    state=state, **self._completions
+                )
+        return self._prompt_cache
+
+    def _split_prompt_fmt(self):
+        """Format the static fields of the prompt format once
+
+        Returns the formatted text either side of each `{state}` field, or
+        None when the format can't be split safely, e.g. the state field uses
+        an index, attribute, conversion or format spec, or the format fails
+        until it is rendered with the real state.
+        """
+        try:
+            fields = list(_FORMATTER.parse(self._prompt_fmt))
+        except ValueError:
+            return None
+        count = 0
+        for _, field, spec, conversion in fields:
+            if field is None:
+                continue
+            if field == "state" and not spec and conversion is None:
+                count += 1
+            elif field.startswith("state") or "{" in (spec or ""):
+                return None
+        try:
+            parts = self._prompt_fmt.format(
+                state=_STATE_MARKER, **self._completions
+            ).split(_STATE_MARKER)
+        except (KeyError, IndexError, AttributeError, TypeError, ValueError):
+            return None
+        # The marker may also appear in the static fields
+        return parts if len(parts) == count + 1 else None
 
     def _push_state(self, state):
-        self._state_stack.append(StackItem(state, {}))
-        if state.get_prompt() is not None:
-            self._prompt_states.append(state.get_prompt())
+        self._context_chain = self._context_chain.new_child()
+        self._state_stack.append(StackItem(state, self._context_chain.maps[0]))
+        prompt = state.get_prompt()
+        if prompt is not None:
+            self._prompt_states.append(prompt)
+            self._prompt_cache = None
 
     def _pop_state(self):
         if self.current_state.get_prompt() is not None:
             self._prompt_states.pop()
+            self._prompt_cache = None
+        self._context_chain = self._context_chain.parents
         return self._state_stack.pop().state
 
     def set_context(self, key, value):
-        self._state_stack[-1].context[key] = value
+        self._context_chain.maps[0][key] = value
 
     def get_context(self, key, default=None):
-        for state in reversed(self._state_stack):
-            value = state.context.get(key, None)
-            if value is not None:
-                return value
-        return default
+        return self._context_chain.get(key, default)
 
     @property
     def current_state(self):
@@ -617,7 +1058,7 @@ class Prompt:
     def _run(self, get_line):
         for line in get_line:
             try:
-                line_parts = [w for w in line.split(" ") if w != ""]
+                line_parts = line.split()
                 if len(line_parts) == 0:
                     continue
 
@@ -629,12 +1070,20 @@ class Prompt:
                 if len(self._state_stack) > 1:
                     new_state = self._pop_state()
                 else:
-                    raise ExitState()
+                    raise
+
+    def _get_session(self, **kwargs):
+        # Building a PromptSession is expensive, so keep it for as long as
+        # it is asked for with the same arguments
+        if self._session is None or kwargs != self._session_kwargs:
+            self._session = PromptSession(
+                **dict(kwargs, completer=self._completer)
+            )
+            self._session_kwargs = kwargs
+        return self._session
 
     def _get_prompt_line(self, **kwargs):
-        kwargs["completer"] = PromptrCompleter(self)
-
-        session = PromptSession(**kwargs)
+        session = self._get_session(**kwargs)
 
         while True:
             try:
@@ -643,7 +1092,7 @@ class Prompt:
                 continue
 
     def run_prompt(self, **kwargs):
-        self._run(iself._get_prompt_line(**kwargs))
+        self._run(self._get_prompt_line(**kwargs))
 
     def run_prompt_loop(self, **kwargs):
         while True:
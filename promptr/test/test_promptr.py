@@ -1,5 +1,9 @@
-from promptr import Prompt, AmbiguousCommand, CommandNotFound, NotEnoughArgs, ExitState, PromptrCompleter
+from promptr import Prompt, AmbiguousCommand, CommandNotFound, NotEnoughArgs, ExitState, PromptrCompleter, Argument, Command, register_class
+from functools import partial
 import pytest
+import sys
+import time
+import weakref
 
 
 @pytest.fixture()
@@ -103,3 +107,310 @@ def test_completion(prompt):
     assert prompt.current_prompt == '(s1)#'
     completions = list(completer.get_completions(Document('c', 1), None))
     assert len(completions) == 1
+
+
+def test_completions_cache():
+    p = Prompt()
+    calls = []
+
+    def intfs():
+        calls.append(1)
+        return ['g0', 'g1']
+
+    @p.command()
+    @p.argument("intf", completions=intfs)
+    def cmd(intf):
+        pass
+
+    param = cmd._params[0]
+    assert param.completions == ['g0', 'g1']
+    assert param.completions == ['g0', 'g1']
+    assert len(calls) == 1
+
+    p.invalidate_completions()
+    assert param.completions == ['g0', 'g1']
+    assert len(calls) == 2
+
+
+def test_completion_after_args(prompt):
+    from prompt_toolkit.document import Document
+    completer = PromptrCompleter(prompt)
+
+    @prompt.group()
+    @prompt.argument("intf", completions=lambda: ['g1', 'g0'])
+    def show(intf):
+        pass
+
+    @show.command()
+    def counters():
+        pass
+
+    def complete(text):
+        return [c.text for c in completer.get_completions(Document(text), None)]
+
+    assert complete('show ') == ['g0', 'g1']
+    assert complete('show g0 ') == ['counters']
+    assert complete('show g0 c') == ['counters']
+    assert complete('state1 test ') == []
+    assert complete('stait ') == []
+
+
+def test_context(prompt):
+    prompt.set_context('count', 0)
+    prompt.run_text("state2")
+    assert prompt.get_context('count') == 0
+    prompt.set_context('count', 1)
+    assert prompt.get_context('count') == 1
+    assert prompt.get_context('missing', 'default') == 'default'
+    prompt.run_text("exit")
+    assert prompt.get_context('count') == 0
+
+
+def test_help():
+    p = Prompt()
+
+    @p.command()
+    def documented():
+        """Run the thing
+
+            in detail
+        """
+
+    @p.command(help="  Explicit help")
+    def explicit():
+        """Ignored"""
+
+    assert documented.help == "Run the thing\n\nin detail"
+    assert explicit.help == "Explicit help"
+    assert repr(explicit) == "<Command explicit [] help=Explicit help>"
+
+
+def test_decorator_method_names():
+    p = Prompt()
+
+    @p.group()
+    def grp():
+        pass
+
+    assert Prompt.command.__qualname__ == "Prompt.command"
+    assert type(grp).state.__qualname__ == "Group.state"
+    assert grp.group.__name__ == "group"
+
+
+def test_prefixed_names():
+    p = Prompt()
+
+    @p.command(optional_prefixes=['no', 'not'], pass_name=True)
+    def shutdown(called_name):
+        p.set_context('called', called_name)
+
+    @p.command(optional_prefixes=['un', 'undo'])
+    def mount():
+        p.set_context('called', 'mount')
+
+    # Either prefixed name could be meant, and the callback is told which
+    with pytest.raises(AmbiguousCommand):
+        p.run_text("n")
+    p.run_text("shut")
+    assert p.get_context('called') == 'shutdown'
+
+    # Both prefixed names run the same callback in the same way
+    p.run_text("un")
+    assert p.get_context('called') == 'mount'
+
+
+def test_completions_persistent(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    calls = []
+
+    def intfs(calls=calls):
+        calls.append(1)
+        return ['g0', 'g1']
+
+    arg = Argument("intf", completions=intfs, completions_persistent=True)
+    assert arg.completions == ['g0', 'g1']
+    assert len(list((tmp_path / 'promptr').iterdir())) == 1
+
+    # A new session reuses the completions saved by the last one
+    arg = Argument("intf", completions=intfs, completions_persistent=True)
+    assert arg.completions == ['g0', 'g1']
+    assert len(calls) == 1
+
+    arg.invalidate()
+    assert list((tmp_path / 'promptr').iterdir()) == []
+    assert arg.completions == ['g0', 'g1']
+    assert len(calls) == 2
+
+    # Anything other than a list of strings on disk is ignored
+    for path in (tmp_path / 'promptr').iterdir():
+        path.write_text('{"g0": 1}')
+    arg = Argument("intf", completions=intfs, completions_persistent=True)
+    assert arg.completions == ['g0', 'g1']
+    assert len(calls) == 3
+    assert [p.suffix for p in (tmp_path / 'promptr').iterdir()] == ['.json']
+
+
+def test_custom_class():
+    p = Prompt()
+
+    @register_class
+    class LoudCommand(Command):
+        pass
+
+    @p.command(cls='LoudCommand')
+    def by_name():
+        pass
+
+    @p.command(cls=LoudCommand)
+    def by_class():
+        pass
+
+    assert isinstance(by_name, LoudCommand)
+    assert isinstance(by_class, LoudCommand)
+
+    with pytest.raises(TypeError):
+        p.command(cls='Prompt')
+
+
+def test_current_prompt(prompt):
+    assert prompt.current_prompt == '#'
+    prompt.run_text("state1 test")
+    assert prompt.current_prompt == '(s1)#'
+    prompt.run_text("exit")
+    assert prompt.current_prompt == '#'
+
+
+def test_exit_state_not_shared(prompt):
+    try:
+        raise ValueError("unrelated")
+    except ValueError:
+        with pytest.raises(ExitState) as first:
+            prompt.run_text("exit")
+    assert isinstance(first.value.__context__, ValueError)
+
+    with pytest.raises(ExitState) as second:
+        prompt.run_text("exit")
+    assert second.value is not first.value
+    assert second.value.__context__ is None
+
+
+def test_completions_persistent_key(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+
+    def lookup(router):
+        return [router + '-g0']
+
+    with pytest.raises(ValueError):
+        Argument(
+            "intf",
+            completions=partial(lookup, 'r1'),
+            completions_persistent=True
+        )
+
+    r1 = Argument(
+        "intf",
+        completions=partial(lookup, 'r1'),
+        completions_persistent=True,
+        completions_cache_key='r1'
+    )
+    r2 = Argument(
+        "intf",
+        completions=partial(lookup, 'r2'),
+        completions_persistent=True,
+        completions_cache_key='r2'
+    )
+    assert r1.completions == ['r1-g0']
+    assert r2.completions == ['r2-g0']
+
+
+def test_completion_budget():
+    from prompt_toolkit.document import Document
+    p = Prompt()
+
+    def slow_intfs():
+        time.sleep(0.1)
+        return ['g0', 'g1', 'g2', 'g3']
+
+    @p.command()
+    @p.argument("intf", completions=slow_intfs)
+    def show(intf):
+        pass
+
+    def complete(completer, text):
+        return [c.text for c in completer.get_completions(Document(text), None)]
+
+    # Fetching the argument completions doesn't count against the budget
+    completer = PromptrCompleter(p)
+    assert complete(completer, 'show ') == ['g0', 'g1', 'g2', 'g3']
+
+    completer.budget = 0
+    assert complete(completer, 'show ') == ['g0', 'g1']
+
+
+def test_static_completions_updated():
+    intfs = ['g0']
+    arg = Argument("intf", completions=intfs)
+    assert list(arg.matching('g')) == ['g0']
+    intfs.append('g1')
+    assert list(arg.matching('g')) == ['g0', 'g1']
+    assert arg.completions == ['g0', 'g1']
+
+    arg = Argument("intf", completions=('g1', 'g0'))
+    assert list(arg.matching('g')) == ['g0', 'g1']
+    ordered = arg._sorted
+    assert list(arg.matching('g')) == ['g0', 'g1']
+    assert arg._sorted is ordered
+
+
+def test_matching_highest_code_point():
+    top = chr(sys.maxunicode)
+    arg = Argument("intf", completions=["a", "a" + top, "a" + top + "b", "ab"])
+    assert list(arg.matching("a")) == ["a", "ab", "a" + top, "a" + top + "b"]
+    assert list(arg.matching("a" + top)) == ["a" + top, "a" + top + "b"]
+
+
+def test_weakref_and_attributes():
+    p = Prompt()
+
+    @p.command()
+    def show():
+        """Show things"""
+
+    assert show.help == "Show things"
+    with pytest.raises(AttributeError):
+        show.extra = 1
+    assert weakref.ref(show)() is show
+    arg = Argument("intf")
+    with pytest.raises(AttributeError):
+        arg.extra = 1
+    assert weakref.ref(arg)() is arg
+
+
+def test_prompt_fmt_fallback():
+    p = Prompt(prompt_fmt='{user}{state}# ')
+    with pytest.raises(KeyError):
+        p.current_prompt
+
+    p = Prompt(prompt_fmt='{state[0]}{state}# ')
+
+    @p.state(prompt="s1")
+    def state1():
+        pass
+
+    p.run_text("state1")
+    assert p.current_prompt == '((s1)# '
+
+
+def test_completion_order():
+    from prompt_toolkit.document import Document
+    p = Prompt()
+    completer = PromptrCompleter(p)
+    for name in ("show", "set", "shutdown", "save"):
+        p.command(name=name)(lambda: None)
+
+    def complete(text):
+        return [c.text for c in completer.get_completions(Document(text), None)]
+
+    assert complete('') == ['exit', 'show', 'set', 'shutdown', 'save']
+    assert complete('s') == ['show', 'set', 'shutdown', 'save']
+    assert complete('sh') == ['show', 'shutdown']
@@ -1,22 +1,18 @@
 import re
 from setuptools import setup, find_packages
 
+_VERSION_RE = re.compile(r'^__version__ = [\'"]([^\'"]+)[\'"]', re.M)
+
 
 def find_version(fname):
     """Attempts to find the version number in the file names fname.
     Raises RuntimeError if not found.
     """
-    version = ""
     with open(fname, "r") as fp:
-        reg = re.compile(r'__version__ = [\'"]([^\'"]*)[\'"]')
-        for line in fp:
-            m = reg.match(line)
-            if m:
-                version = m.group(1)
-                break
-    if not version:
+        m = _VERSION_RE.search(fp.read())
+    if not m:
         raise RuntimeError("Cannot find version information")
-    return version
+    return m.group(1)
 
 
 def read(fname):